@@ -1,10 +1,9 @@
 from .models import BFASTMonitor
+from importlib.util import find_spec
 from warnings import warn
 
 __version__ = '0.8.dev0'
 
-# check that cupy is installed 
-try: 
-    import cupy 
-except ModuleNotFoundError:
+# check that cupy is installed (without importing it)
+if find_spec("cupy") is None:
     warn("cupy is not available in this environment, GPU fonctionnalities won't be available")
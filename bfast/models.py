@@ -1,4 +1,4 @@
-from bfast.monitor import *
+from bfast.monitor import BFASTMonitorPython
 
 class BFASTMonitor():
     """
@@ -58,6 +58,10 @@ class BFASTMonitor():
         If magnitudes should be returned or not.
         Disabling this would improve the performance greatly
 
+    n_jobs : int, default None
+        The number of processes used by backend='python-mp'
+        (defaults to the number of CPUs).
+
 
     Attributes
     ----------
@@ -95,6 +99,7 @@ class BFASTMonitor():
             device_id=0,
             detailed_results=False,
             find_magnitudes=True,
+            n_jobs=None,
         ):
         self.start_monitor = start_monitor
         self.freq = freq
@@ -109,6 +114,7 @@ class BFASTMonitor():
         self.device_id = device_id
         self.detailed_results = detailed_results
         self.find_magnitudes = find_magnitudes
+        self.n_jobs = n_jobs
 
         self._model = None
 
@@ -148,10 +154,13 @@ class BFASTMonitor():
                 level=self.level,
                 period=self.period,
                 verbose=self.verbose,
-                use_mp=True
+                use_mp=True,
+                n_jobs=self.n_jobs
             )
 
         elif self.backend == 'opencl':
+            from bfast.monitor import BFASTMonitorOpenCL
+
             self._model = BFASTMonitorOpenCL(
                 start_monitor=self.start_monitor,
                 freq=self.freq,
@@ -230,7 +239,8 @@ class BFASTMonitor():
             "platform_id": self.platform_id,
             "device_id": self.device_id,
             "detailed_results": self.detailed_results,
-            "find_magnitudes": self.find_magnitudes
+            "find_magnitudes": self.find_magnitudes,
+            "n_jobs": self.n_jobs
         }
 
         return params
@@ -1,2 +1,17 @@
-from .opencl import BFASTMonitorOpenCL
 from .python import BFASTMonitorPython
+
+__all__ = ["BFASTMonitorPython", "BFASTMonitorOpenCL"]
+
+
+def __getattr__(name):
+    # lazy import of the OpenCL backend (pyopencl and the
+    # generated Futhark code are only loaded if needed)
+    if name == "BFASTMonitorOpenCL":
+        from .opencl import BFASTMonitorOpenCL
+        return BFASTMonitorOpenCL
+
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
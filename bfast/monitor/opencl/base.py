@@ -8,7 +8,6 @@ import gc
 import time
 from datetime import datetime
 
-import pandas
 import numpy
 import pyopencl
 import pyopencl.array as pycl_array
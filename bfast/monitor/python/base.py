@@ -5,7 +5,7 @@ Created on Apr 19, 2018
 '''
 
 import multiprocessing as mp
-from functools import partial
+from functools import lru_cache, partial
 
 import numpy as np
 #np.warnings.filterwarnings('ignore')
@@ -14,6 +14,35 @@ import numpy as np
 from bfast.base import BFASTMonitorBase
 from bfast.monitor.utils import compute_end_history, compute_lam, map_indices
 
+# minimum number of pixels for which the jitted MOSUM
+# evaluation is spread over several threads
+PARALLEL_MIN_PIXELS = 1024
+
+# number of pixels whose MOSUM processes are evaluated at once
+# without numba (which needs several intermediate (N, P) arrays)
+NUMPY_BLOCK_PIXELS = 1024
+
+
+@lru_cache(maxsize=None)
+def _get_detect_breaks_kernel(parallel):
+    """ Returns the jitted kernel evaluating the MOSUM processes
+    of several pixels (multi-threaded if parallel=True), or None
+    if numba is not available (the processes are then evaluated
+    with plain Numpy). numba is only imported (and the kernel only
+    compiled) the first time it is needed.
+    """
+    # (an installed numba that is incompatible with the installed
+    # Numpy raises a plain ImportError)
+    try:
+        from bfast.monitor.python import kernels
+    except ImportError:
+        return None
+
+    if parallel:
+        return kernels.detect_breaks_parallel
+
+    return kernels.detect_breaks
+
 
 class BFASTMonitorPython(BFASTMonitorBase):
     """ BFAST Monitor implementation based on Python and Numpy. The
@@ -30,7 +59,8 @@ class BFASTMonitorPython(BFASTMonitorBase):
                  verbose=0,
                  use_mp=False,
                  use_gpu=False,
-                 device_id=0
+                 device_id=0,
+                 n_jobs=None
                  ):
 
     Parameters
@@ -76,6 +106,11 @@ class BFASTMonitorPython(BFASTMonitorBase):
     device_id int, default 0
         Specified the GPU device id.
 
+    n_jobs : int, default None
+        The number of processes used if use_mp=True (the
+        image rows are split into one block per process).
+        Defaults to the number of CPUs.
+
     """
     def __init__(self,
                  start_monitor,
@@ -88,7 +123,8 @@ class BFASTMonitorPython(BFASTMonitorBase):
                  verbose=0,
                  use_mp=False,
                  use_gpu=False,
-                 device_id=0
+                 device_id=0,
+                 n_jobs=None
                  ):
         
         super().__init__(start_monitor,
@@ -115,6 +151,7 @@ class BFASTMonitorPython(BFASTMonitorBase):
 
         self._timers = {}
         self.use_mp = use_mp
+        self.n_jobs = n_jobs
 
     def fit(self, data, dates, nan_value=0, **kwargs):
         """ Fits the models for the ndarray 'data'
@@ -139,11 +176,15 @@ class BFASTMonitorPython(BFASTMonitorBase):
             The object itself.
         """
         
-        data_ints = np.copy(data)
-        data = np.array(np.copy(data_ints)).astype(np.float32)
+        # (the input is only read, a single float32 copy is made)
+        data_ints = np.asarray(data)
+        data = data_ints.astype(np.float32)
 
-        # set NaN values
-        data[data_ints==nan_value] = np.nan
+        # set NaN values (and keep their mask)
+        nans = data_ints == nan_value
+        if np.issubdtype(data_ints.dtype, np.floating):
+            nans |= np.isnan(data_ints)
+        np.copyto(data, np.nan, where=nans)
 
         self.n = compute_end_history(dates, self.start_monitor)
 
@@ -151,57 +192,72 @@ class BFASTMonitorPython(BFASTMonitorBase):
         self.mapped_indices = np.array(map_indices(dates)).astype(np.int32)
         self.X = self._create_data_matrix(self.mapped_indices)
 
+        # history patterns and their (flattened) outer products, which
+        # are shared by the regression models of all pixels
+        self.X_h = self.X[:, :self.n]
+        self.XX_h = np.einsum('it,jt->tij', self.X_h, self.X_h).reshape(self.n, -1)
+
         # period = data.shape[0] / np.float(self.n)
         self.lam = np.array(compute_lam(data.shape[0], self.hfrac, self.level, self.period))
 
+        # boundary (shared by all pixels)
+        a = self.mapped_indices[self.n:] / self.mapped_indices[self.n - 1].astype(np.float)
+        self.bounds = self.lam * np.sqrt(self._log_plus(a))
+        if self.verbose:
+            print("lambda", self.lam)
+            print("bounds", self.bounds)
+
         if self.use_mp and not self.use_gpu:
-            print("Python backend is running in parallel using {} threads".format(mp.cpu_count()))
-            y = np.transpose(data, (1, 2, 0)).reshape(data.shape[1] * data.shape[2], data.shape[0])
-            pool = mp.Pool(mp.cpu_count())
-            p_map = pool.map(self.fit_single, y)
-            rval = np.array(p_map, dtype=object).reshape(data.shape[1], data.shape[2], 4)
-
-            self.breaks = rval[:,:,0].astype(np.int32)
-            self.means = rval[:,:,1].astype(np.float32)
-            self.magnitudes = rval[:,:,2].astype(np.float32)
-            self.valids = rval[:,:,3].astype(np.int32)
-            
+            n_jobs = self.n_jobs or mp.cpu_count()
+            print("Python backend is running in parallel using {} processes".format(n_jobs))
+
+            # one block of image rows per process (each one being
+            # fitted at once, with a single-threaded kernel)
+            blocks = zip(np.array_split(data, n_jobs, axis=1),
+                         np.array_split(nans, n_jobs, axis=1))
+            blocks = [(y.reshape(y.shape[0], -1), m.reshape(y.shape[0], -1))
+                      for y, m in blocks]
+            with mp.Pool(n_jobs) as pool:
+                p_map = pool.starmap(partial(self._fit_batch, parallel=False), blocks)
+            breaks, means, magnitudes, valids = (np.concatenate(r) for r in zip(*p_map))
+
         else:
-            
-            rval = np.apply_along_axis(self.fit_single, 0, data)
-            
-            self.breaks = rval[0].astype(np.int32)
-            self.means = rval[1].astype(np.float32)
-            self.magnitudes = rval[2].astype(np.float32)
-            self.valids = rval[3].astype(np.int32)
+
+            y = data.reshape(data.shape[0], data.shape[1] * data.shape[2])
+            nans = nans.reshape(y.shape)
+            breaks, means, magnitudes, valids = self._fit_batch(y, nans)
+
+        self.breaks = breaks.reshape(data.shape[1:])
+        self.means = means.reshape(data.shape[1:])
+        self.magnitudes = magnitudes.reshape(data.shape[1:])
+        self.valids = valids.reshape(data.shape[1:])
 
         return self
 
     def fit_single(self, y):
-        """ Fits the BFAST model for the 1D array y.
+        """ Fits the BFAST model for the 1D array y. Note that
+        fit processes all pixels at once (see _fit_batch); this
+        method allows to fit single time series (after fit has
+        been called for the same dates).
 
         Parameters
         ----------
         y : array
-            1d array of length N
+            1d array of length N (nan for missing values)
 
         Returns
         -------
-        self : instance of BFASTCPU
-            The object itself
+        rval : array
+            The break, mean, magnitude and number of
+            valid values of the time series
         """
-        N = y.shape[0]
-
         # compute nan mappings
-        nans = np.isnan(y)
-        num_nans = np.cumsum(nans)
-        val_inds = np.array(range(N))[~nans]
+        vals = ~np.isnan(y)
+        val_inds = np.flatnonzero(vals)
 
         # compute new limits (in data NOT containing missing values)
-        # ns = n - num_nans[self.n]
-        ns = self.n - num_nans[self.n - 1]
-        h = np.int(float(ns) * self.hfrac)
-        Ns = N - num_nans[N - 1]
+        ns = np.count_nonzero(vals[:self.n])
+        Ns = val_inds.shape[0]
 
         if ns <= 5 or Ns - ns <= 5:
             brk = -2
@@ -218,44 +274,218 @@ class BFASTMonitorPython(BFASTMonitorBase):
         val_inds -= self.n
 
         # remove nan values from patterns+targets
-        X_nn = self.X[:, ~nans]
-        y_nn = y[~nans]
+        X_nn = self.X[:, vals]
+        y_nn = y[vals]
 
         # split data into history and monitoring phases
         X_nn_h = X_nn[:, :ns]
-        X_nn_m = X_nn[:, ns:]
         y_nn_h = y_nn[:ns]
-        y_nn_m = y_nn[ns:]
-        
+
         # (1) fit linear regression model for history period
-        coef = np.linalg.pinv(X_nn_h@X_nn_h.T)@X_nn_h@y_nn_h
+        # (fewer observations than patterns yield singular normal
+        # equations, which are solved via the pseudo-inverse)
+        XX = X_nn_h@X_nn_h.T
+        Xy = X_nn_h@y_nn_h
+        if ns >= self.X.shape[0]:
+            coef = self._solve_normal_equations(XX, Xy)
+        else:
+            coef = np.linalg.pinv(XX)@Xy
 
         if self.verbose > 1:
-            column_names = np.array(["harmonsin1",
-                                     "harmoncos1",
-                                     "harmonsin2",
-                                     "harmoncos2",
-                                     "harmonsin3",
-                                     "harmoncos3"])
-            if self.trend:
-                indxs = np.array([1, 3, 5, 7, 2, 4, 6])
-            else:
-                indxs = np.array([2, 4, 6, 1, 3, 5])
-            print(column_names[indxs])
-            print(coef[indxs])
+            self._print_coef(coef)
 
         # get predictions for all non-nan points
         y_pred = X_nn.T@coef
         y_error = y_nn - y_pred
 
         # (2) evaluate model on monitoring period mosum_nn process
-        err_cs = np.cumsum(y_error[ns - h:Ns + 1])
+        first_break, mean = self._detect_break(y_error, val_inds, ns, Ns)
+
+        # compute magnitude
+        magnitude = np.median(y_error[ns:])
+
+        rval = np.array([first_break, mean, magnitude.item(), Ns])
+
+        return rval
+
+    def _fit_batch(self, y, nans, parallel=True):
+        """ Fits the BFAST model for all columns of the 2D array y.
+        The regression models of all pixels are fitted at once
+        since the patterns are shared among them; only the
+        MOSUM processes are evaluated per pixel (by a jitted,
+        multi-threaded kernel if numba is available).
+
+        Parameters
+        ----------
+        y : array
+            2d array of shape (N, P), one time series per column
+        nans : array
+            2d boolean array of shape (N, P) marking the
+            NaN values in y
+        parallel : bool, default True
+            Whether the jitted kernel may use several threads
+
+        Returns
+        -------
+        breaks, means, magnitudes, valids : arrays
+            1d arrays of length P
+        """
+        N, P = y.shape
+
+        # compute nan mappings
+        ns = self.n - np.count_nonzero(nans[:self.n], axis=0)
+        Ns = N - np.count_nonzero(nans, axis=0)
+
+        breaks = np.full(P, -2, dtype=np.int32)
+        means = np.zeros(P, dtype=np.float32)
+        magnitudes = np.zeros(P, dtype=np.float32)
+        valids = Ns.astype(np.int32)
+
+        # pixels without enough observations are skipped altogether
+        enough = (ns > 5) & (Ns - ns > 5)
+        if self.verbose > 1:
+            for ns_p, Ns_p in zip(ns[~enough], Ns[~enough]):
+                print("WARNING: Not enough observations: ns={ns}, Ns={Ns}".format(ns=ns_p, Ns=Ns_p))
+
+        if not enough.any():
+            return breaks, means, magnitudes, valids
+
+        if not enough.all():
+            y, nans, ns, Ns = y[:, enough], nans[:, enough], ns[enough], Ns[enough]
+            P = y.shape[1]
+
+        # (1) fit linear regression models for history period
+        n_patterns = self.X.shape[0]
+        y_h = np.where(nans[:self.n], 0, y[:self.n])
+        Xy = (self.X_h @ y_h).T
+        coef = np.empty(Xy.shape)
+
+        # pixels without missing values in the history period share
+        # the same normal equations, which are solved only once
+        complete = ns == self.n
+        if self.n < n_patterns:
+            complete[:] = False
+        if complete.any():
+            XX = self.X_h @ self.X_h.T
+            coef[complete] = self._solve_normal_equations(XX, Xy[complete].T).T
+
+        # for all other pixels, missing values are excluded by
+        # zeroing their weights/targets
+        gaps = ~complete
+        w_h = (~nans[:self.n, gaps]).astype(self.X.dtype)
+        XX = (w_h.T @ self.XX_h).reshape(-1, n_patterns, n_patterns)
+        Xy_g = Xy[gaps, :, np.newaxis]
+        full = ns[gaps] >= n_patterns
+        coef_g = np.empty(Xy_g.shape)
+        coef_g[full] = self._solve_normal_equations(XX[full], Xy_g[full])
+        coef_g[~full] = np.linalg.pinv(XX[~full]) @ Xy_g[~full]
+        coef[gaps] = coef_g[:, :, 0]
+
+        if self.verbose > 1:
+            for coef_p in coef:
+                self._print_coef(coef_p)
+
+        # get predictions for all points
+        # (in single precision like the data; only the normal
+        # equations need double precision); the residuals are
+        # stored pixel-major, i.e., with shape (P, N), such that
+        # the time series of each pixel is contiguous in memory
+        y_pred = coef.astype(np.float32) @ self.X.astype(np.float32)
+        y_error = np.subtract(y.T, y_pred, out=y_pred)
+
+        # (2) evaluate model on monitoring period mosum_nn processes
+        breaks_e = np.empty(P, dtype=np.int32)
+        means_e = np.empty(P, dtype=np.float32)
+        magnitudes_e = np.empty(P, dtype=np.float32)
+
+        kernel = _get_detect_breaks_kernel(parallel and P >= PARALLEL_MIN_PIXELS)
+        if kernel is not None:
+            # (the mask is passed pixel-major as well)
+            kernel(y_error, np.ascontiguousarray(nans.T), ns, Ns,
+                   self.hfrac, self.k, self.n, self.bounds,
+                   breaks_e, means_e, magnitudes_e)
+        else:
+            for start in range(0, P, NUMPY_BLOCK_PIXELS):
+                block = slice(start, start + NUMPY_BLOCK_PIXELS)
+                y_error_b = y_error[block]
+                breaks_e[block], means_e[block] = self._detect_breaks(
+                    y_error_b.T, nans[:, block], ns[block], Ns[block])
+
+                # magnitudes of all pixels of the block at once, i.e., the
+                # medians of the monitoring residuals (sorting moves nan
+                # values to the end)
+                m = Ns[block] - ns[block]
+                y_error_m = np.sort(y_error_b[:, self.n:], axis=1)
+                rows = np.arange(y_error_m.shape[0])
+                magnitudes_e[block] = 0.5 * (y_error_m[rows, (m - 1) // 2] + y_error_m[rows, m // 2])
+
+        breaks[enough] = breaks_e
+        means[enough] = means_e
+        magnitudes[enough] = magnitudes_e
+
+        return breaks, means, magnitudes, valids
+
+    def _detect_breaks(self, y_error, nans, ns, Ns):
+        """ Computes the MOSUM processes for all columns of the
+        (N, P) residuals y_error at once and checks them against
+        the boundary. All columns need to contain enough observations.
+
+        Returns
+        -------
+        breaks, means : arrays
+            1d arrays of length P
+        """
+        N, P = y_error.shape
+        cols = np.arange(P)
+        h = (ns * self.hfrac).astype(np.int64)
+
+        # cumulative sums of the (non-nan) residuals, both w.r.t. the
+        # original time axis (err_cs) and w.r.t. the non-nan values
+        # of each pixel (err_cs_nn[j] is the sum of the first j ones)
+        vals = ~nans
+        err = np.zeros((N, P))
+        np.copyto(err, y_error, where=vals)
+        err_cs = np.cumsum(err, axis=0)
+        num_vals = np.cumsum(vals, axis=0)
+        err_cs_nn = np.zeros((N + 1, P))
+        rows, vcols = np.nonzero(vals)
+        err_cs_nn[num_vals[rows, vcols], vcols] = err_cs[rows, vcols]
+
+        # moving sums over the last h (non-nan) residuals (only valid
+        # for the non-nan values of the monitoring period)
+        valid = vals[self.n:]
+        mosum = err_cs[self.n:] - err_cs_nn[num_vals[self.n:] - h, cols]
+
+        sigma = np.sqrt(np.einsum('ij,ij->j', err[:self.n], err[:self.n]) / (ns - (2 + 2 * self.k)))
+        mosum *= 1.0 / (sigma * np.sqrt(ns))
+
+        # compute means
+        means = np.where(valid, mosum, 0).sum(axis=0) / (Ns - ns)
+
+        # boundary and breaks
+        crossed = (np.abs(mosum) > self.bounds[:, np.newaxis]) & valid
+        breaks = np.where(crossed.any(axis=0), np.argmax(crossed, axis=0), -1)
+
+        return breaks, means
+
+    def _detect_break(self, y_error, val_inds, ns, Ns):
+        """ Computes the MOSUM process for the (non-nan)
+        residuals y_error of a single pixel and checks
+        it against the boundary.
+
+        Returns
+        -------
+        first_break, mean : int, float
+        """
+        h = int(float(ns) * self.hfrac)
+
+        err_cs = np.cumsum(y_error[ns - h:Ns + 1], dtype=np.float64)
         mosum_nn = err_cs[h:] - err_cs[:-h]
 
-        sigma = np.sqrt(np.sum(y_error[:ns] ** 2) / (ns - (2 + 2 * self.k)))
+        sigma = np.sqrt(np.sum(y_error[:ns] ** 2, dtype=np.float64) / (ns - (2 + 2 * self.k)))
         mosum_nn = 1.0 / (sigma * np.sqrt(ns)) * mosum_nn
 
-        mosum = np.full(N - self.n, np.nan)
+        mosum = np.full(self.bounds.shape[0], np.nan)
         mosum[val_inds[:Ns - ns]] = mosum_nn
         if self.verbose:
             print("MOSUM process", mosum_nn.shape)
@@ -263,28 +493,16 @@ class BFASTMonitorPython(BFASTMonitorBase):
         # compute mean
         mean = np.mean(mosum_nn)
 
-        # compute magnitude
-        magnitude = np.median(y_error[ns:])
-
         # boundary and breaks
-        a = self.mapped_indices[self.n:] / self.mapped_indices[self.n - 1].astype(np.float)
-        bounds = self.lam * np.sqrt(self._log_plus(a))
-
-        if self.verbose:
-            print("lambda", self.lam)
-            print("bounds", bounds)
-
-        breaks = np.abs(mosum) > bounds
-        first_break = np.nonzero(breaks)[0]
+        # (only the first crossing is of interest, no need to
+        # collect the indices of all of them)
+        breaks = np.abs(mosum) > self.bounds
+        first_break = np.argmax(breaks).item()
 
-        if first_break.shape[0] > 0:
-            first_break = first_break[0].item()
-        else:
+        if not breaks[first_break]:
             first_break = -1
 
-        rval = np.array([first_break, mean.item(), magnitude.item(), Ns.item()])
-        
-        return rval
+        return first_break, mean.item()
 
     def get_timers(self):
         """ Returns runtime measurements for the
@@ -301,17 +519,43 @@ class BFASTMonitorPython(BFASTMonitorBase):
         N = mapped_indices.shape[0]
         temp = 2 * np.pi * mapped_indices / np.float(self.freq)
 
+        offset = 2 if self.trend else 1
+        X = np.empty((offset + 2 * self.k, N))
+        X[0] = 1
         if self.trend:
-            X = np.vstack((np.ones(N), mapped_indices))
-        else:
-            X = np.ones(N)
+            X[1] = mapped_indices
 
-        for j in np.arange(1, self.k + 1):
-            X = np.vstack((X, np.sin(j * temp)))
-            X = np.vstack((X, np.cos(j * temp)))
+        # harmonic terms of all orders at once (sin/cos interleaved)
+        temp = np.arange(1, self.k + 1)[:, np.newaxis] * temp
+        np.sin(temp, out=X[offset::2])
+        np.cos(temp, out=X[offset + 1::2])
 
         return X
 
+    def _print_coef(self, coef):
+        """ Prints the coefficients of a single regression
+        model along with their names (verbose output).
+        """
+        if self.trend:
+            names = ["(Intercept)", "trend"]
+        else:
+            names = ["(Intercept)"]
+        for j in range(1, self.k + 1):
+            names += ["harmonsin{}".format(j), "harmoncos{}".format(j)]
+
+        print(np.array(names))
+        print(coef)
+
+    def _solve_normal_equations(self, XX, Xy):
+        """ Solves the (stacked) normal equations XX coef = Xy
+        directly; resorts to the pseudo-inverse if the systems
+        turn out to be singular.
+        """
+        try:
+            return np.linalg.solve(XX, Xy)
+        except np.linalg.LinAlgError:
+            return np.linalg.pinv(XX) @ Xy
+
     def _log_plus(self, a):
         retval = np.ones(a.shape, dtype=np.float)
         fl = a > np.e
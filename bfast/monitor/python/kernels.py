@@ -0,0 +1,74 @@
+'''
+Jitted (numba) kernels of the Python backend; this module is
+only imported by BFASTMonitorPython if numba is available.
+'''
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(nogil=True, cache=True, error_model="numpy")
+def detect_break(y_error, nans, ns, Ns, h, k, n, bounds):
+    """ Jitted counterpart of BFASTMonitorPython._detect_break
+    operating on the residuals y_error of a single pixel (with
+    the missing values marked by nans); also returns the
+    magnitude."""
+    N = y_error.shape[0]
+
+    # remove missing values (and keep track of their positions); the
+    # sum of squares of the history residuals and the first moving
+    # sum are accumulated in the same pass (in double precision).
+    # The mask has to be used here (and not np.isnan), since it
+    # also determines ns and Ns, and the residuals of valid values
+    # may be nan as well (e.g., for infinite input values)
+    y_nn = np.empty(Ns, dtype=y_error.dtype)
+    val_inds = np.empty(Ns, dtype=np.int64)
+    sigma = 0.0
+    mosum = 0.0
+    j = 0
+    for i in range(N):
+        if not nans[i]:
+            e = y_error[i]
+            y_nn[j] = e
+            val_inds[j] = i - n
+            if j < ns:
+                sigma += e * e
+                if j >= ns - h:
+                    mosum += e
+            j += 1
+
+    sigma = np.sqrt(sigma / (ns - (2 + 2 * k)))
+    scale = 1.0 / (sigma * np.sqrt(ns))
+
+    # moving sums over h (non-nan) residuals
+    mean = 0.0
+    first_break = -1
+    for j in range(ns, Ns):
+        mosum += y_nn[j] - y_nn[j - h]
+        mean += mosum * scale
+        if first_break < 0 and np.abs(mosum * scale) > bounds[val_inds[j]]:
+            first_break = val_inds[j]
+
+    return first_break, mean / (Ns - ns), np.median(y_nn[ns:])
+
+
+@njit(nogil=True, cache=True, error_model="numpy")
+def detect_breaks(y_error, nans, ns, Ns, hfrac, k, n, bounds,
+                  breaks, means, magnitudes):
+    """ Evaluates the MOSUM processes of all rows of the (P, N)
+    residuals y_error (all of which need to contain enough
+    observations); nans is the (P, N) mask of missing values."""
+    for p in range(y_error.shape[0]):
+        h = int(ns[p] * hfrac)
+        breaks[p], means[p], magnitudes[p] = detect_break(
+            y_error[p], nans[p], ns[p], Ns[p], h, k, n, bounds)
+
+
+@njit(parallel=True, nogil=True, cache=True, error_model="numpy")
+def detect_breaks_parallel(y_error, nans, ns, Ns, hfrac, k, n, bounds,
+                           breaks, means, magnitudes):
+    """ Multi-threaded version of detect_breaks."""
+    for p in prange(y_error.shape[0]):
+        h = int(ns[p] * hfrac)
+        breaks[p], means[p], magnitudes[p] = detect_break(
+            y_error[p], nans[p], ns[p], Ns[p], h, k, n, bounds)
@@ -1,7 +1,6 @@
 from datetime import datetime
 
 import numpy as np
-import pandas
 
 
 __critvals = np.array([1.22762665817831, 1.68732328328598, 2.22408818231127,
@@ -471,14 +470,16 @@ def compute_end_history(dates, start_monitor):
     raise Exception("Date 'start' not within the range of dates!")
 
 def map_indices(dates):
+    """ Maps the dates to their positions in the daily range
+    starting at the first of January of the first year, i.e.,
+    the days since then. The dates are expected to be sorted
+    (as for the data); the indices are returned in the order
+    of the dates (the former pandas-based implementation
+    returned them sorted instead).
+    """
     start = dates[0]
-    end = dates[-1]
     start = datetime(start.year, 1, 1)
-    end = datetime(end.year, 12, 31)
 
-    drange = pandas.date_range(start, end, freq="d")
-    ts = pandas.Series(np.ones(len(dates)), dates)
-    ts = ts.reindex(drange)
-    indices = np.argwhere(~np.isnan(ts).to_numpy()).T[0]
+    indices = np.array([(d - start).days for d in dates])
 
     return indices
@@ -0,0 +1,145 @@
+'''
+Regression tests for the Python backend: the batched fit (jitted or
+pure Numpy) has to yield the same results as fitting each time series
+on its own via fit_single.
+'''
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from bfast.monitor.python import base
+from bfast.monitor.python.base import BFASTMonitorPython
+from bfast.monitor.utils import compute_end_history
+
+NAN_VALUE = -32768
+START_MONITOR = datetime(2010, 1, 1)
+DATES = [datetime(2005, 1, 1) + timedelta(days=16 * i) for i in range(200)]
+N_HISTORY = compute_end_history(DATES, START_MONITOR)
+
+try:
+    from bfast.monitor.python import kernels
+except ImportError:
+    kernels = None
+
+
+def make_scene(W=8, H=8, missing=0.2, seed=0):
+    """ Seasonal time series with breaks in a quarter of the pixels,
+    missing values and a few corner cases."""
+    rng = np.random.default_rng(seed)
+    N = len(DATES)
+    t = np.arange(N)
+    season = 5000 + 1500 * np.sin(2 * np.pi * t * 16 / 365.)
+    data = season[:, None, None] + rng.normal(0, 300, (N, W, H))
+
+    # breaks in the monitoring period
+    data[N_HISTORY + 40:, :W // 2, :H // 2] -= 2500
+
+    data = data.astype(np.int16)
+    if missing > 0:
+        data[rng.random(data.shape) < missing] = NAN_VALUE
+
+        # not any valid value
+        data[:, 0, 0] = NAN_VALUE
+        # not enough observations in the history period
+        data[:N_HISTORY - 3, 0, 1] = NAN_VALUE
+        # fewer observations than patterns in the history period
+        # (solved via the pseudo-inverse)
+        hist = np.flatnonzero(data[:N_HISTORY, 0, 2] != NAN_VALUE)
+        data[hist[7:], 0, 2] = NAN_VALUE
+
+    return data
+
+
+def fit(data, **kwargs):
+    model = BFASTMonitorPython(START_MONITOR, freq=365, k=3, hfrac=0.25,
+                               trend=True, level=0.05, **kwargs)
+    model.fit(data, DATES, nan_value=NAN_VALUE)
+
+    return model
+
+
+def fit_pixels(model, data):
+    """ Reference results (fit_single applied to every pixel)."""
+    y = data.astype(np.float64)
+    y[data == NAN_VALUE] = np.nan
+    y = np.transpose(y, (1, 2, 0)).reshape(-1, y.shape[0])
+    rval = np.array([model.fit_single(y_p) for y_p in y])
+
+    return rval.reshape(data.shape[1], data.shape[2], 4)
+
+
+def assert_same_results(model, rval):
+    np.testing.assert_array_equal(model.breaks, rval[..., 0])
+    np.testing.assert_allclose(model.means, rval[..., 1], rtol=1e-3, atol=1e-3)
+    np.testing.assert_allclose(model.magnitudes, rval[..., 2], rtol=1e-3, atol=1e-2)
+    np.testing.assert_array_equal(model.valids, rval[..., 3])
+
+
+@pytest.fixture(params=["numba", "numpy"])
+def kernel(request, monkeypatch):
+    """ Runs a test with the jitted kernels and with the
+    pure Numpy implementation."""
+    if request.param == "numba":
+        if kernels is None:
+            pytest.skip("numba is not available")
+    else:
+        monkeypatch.setattr(base, "_get_detect_breaks_kernel", lambda parallel: None)
+
+    return request.param
+
+
+def test_missing_values(kernel):
+    data = make_scene()
+    model = fit(data)
+    rval = fit_pixels(model, data)
+
+    assert_same_results(model, rval)
+
+    # corner cases and detected breaks
+    assert model.breaks[0, 0] == -2
+    assert model.breaks[0, 1] == -2
+    assert model.breaks[0, 2] != -2
+    assert (model.breaks[:4, :4] >= 0).sum() > 8
+    assert model.valids[0, 0] == 0
+
+
+def test_no_missing_values(kernel):
+    data = make_scene(missing=0)
+    model = fit(data)
+    rval = fit_pixels(model, data)
+
+    assert_same_results(model, rval)
+    assert (model.valids == len(DATES)).all()
+
+
+def test_infinite_values(kernel):
+    data = make_scene().astype(np.float32)
+    data[10, 1, 1] = np.inf
+    model = fit(data)
+
+    # (nan residuals for all values of the pixel)
+    assert model.breaks[1, 1] == -1
+    assert np.isnan(model.means[1, 1])
+    assert np.isnan(model.magnitudes[1, 1])
+    assert model.valids[1, 1] == np.count_nonzero(data[:, 1, 1] != NAN_VALUE)
+
+
+def test_multiprocessing(kernel):
+    data = make_scene()
+    model = fit(data, use_mp=True, n_jobs=3)
+    rval = fit_pixels(fit(data), data)
+
+    assert_same_results(model, rval)
+
+
+def test_large_scene(kernel):
+    # (multi-threaded kernel or several blocks of pixels)
+    data = make_scene(W=40, H=32)
+    assert data.shape[1] * data.shape[2] > base.PARALLEL_MIN_PIXELS
+    assert data.shape[1] * data.shape[2] > base.NUMPY_BLOCK_PIXELS
+    model = fit(data)
+    rval = fit_pixels(model, data)
+
+    assert_same_results(model, rval)